@@ -1,7 +1,8 @@
 import databutton as db
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, BackgroundTasks, HTTPException
 from pydantic import BaseModel, Field, EmailStr
 from typing import Optional
+import html
 import time
 
 # Initialize router
@@ -18,51 +19,71 @@ class FeedbackResponse(BaseModel):
     success: bool = Field(..., description="Whether the feedback was sent successfully")
     message: str = Field(..., description="A message about the feedback status")
 
-@router.post("/send-feedback", response_model=FeedbackResponse)
-def send_feedback(request: FeedbackRequest):
-    """Send feedback via email"""
-    try:
-        # Format the email content
-        subject = f"StudyGeni Feedback {int(time.time())}"
-        
-        # Format email body
-        email_content = f"""<html>
+# Email templates built once at import time; per-request rendering is a
+# single format_map over the cached strings
+_FEEDBACK_HTML_TEMPLATE = """<html>
         <body>
             <h2>New Feedback from StudyGeni</h2>
-            
-            <p><strong>From:</strong> {request.name or 'Anonymous'}</p>
-            <p><strong>Email:</strong> {request.email or 'Not provided'}</p>
-            
+
+            <p><strong>From:</strong> {name}</p>
+            <p><strong>Email:</strong> {email}</p>
+
             <h3>Feedback:</h3>
-            <p>{request.feedback}</p>
-            
+            <p>{feedback}</p>
+
             <hr>
             <p>This email was sent from the StudyGeni feedback system.</p>
         </body>
         </html>"""
-        
-        # Plain text version
-        text_content = f"""
+
+_FEEDBACK_TEXT_TEMPLATE = """
         New Feedback from StudyGeni
-        
-        From: {request.name or 'Anonymous'}
-        Email: {request.email or 'Not provided'}
-        
+
+        From: {name}
+        Email: {email}
+
         Feedback:
-        {request.feedback}
-        
+        {feedback}
+
         ---
         This email was sent from the StudyGeni feedback system.
         """
-        
-        # Send the email using Databutton's email service
+
+# Deliver the email outside the request/response cycle; failures are logged
+# since the client has already been answered
+def _send_feedback_email(subject: str, content_html: str, content_text: str):
+    try:
         db.notify.email(
             to="manamnathtiwari@gmail.com",
             subject=subject,
-            content_html=email_content,
-            content_text=text_content,
+            content_html=content_html,
+            content_text=content_text,
         )
-        
+    except Exception as e:
+        print(f"Error sending feedback email: {str(e)}")
+
+@router.post("/send-feedback", response_model=FeedbackResponse)
+def send_feedback(request: FeedbackRequest, background_tasks: BackgroundTasks):
+    """Send feedback via email"""
+    try:
+        # Format the email content
+        subject = f"StudyGeni Feedback {int(time.time())}"
+
+        # Render both bodies from the cached templates. The fields are user
+        # input, so escape them for the HTML body to keep submitted markup
+        # from rendering in the outbound email
+        fields = {
+            "name": request.name or "Anonymous",
+            "email": request.email or "Not provided",
+            "feedback": request.feedback,
+        }
+        escaped_fields = {key: html.escape(value) for key, value in fields.items()}
+        email_content = _FEEDBACK_HTML_TEMPLATE.format_map(escaped_fields)
+        text_content = _FEEDBACK_TEXT_TEMPLATE.format_map(fields)
+
+        # Queue the email so the response isn't held up by the SMTP round trip
+        background_tasks.add_task(_send_feedback_email, subject, email_content, text_content)
+
         return FeedbackResponse(
             success=True,
             message="Feedback sent successfully"
@@ -1,13 +1,22 @@
 import databutton as db
+import google.ai.generativelanguage as glm
 import google.generativeai as genai
 from fastapi import APIRouter, HTTPException, UploadFile, File, Form
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from enum import Enum
 from typing import List, Optional, Union
-import io
+import asyncio
+import datetime
+import hashlib
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
 import fitz  # PyMuPDF
-import re
-from time import sleep
 
 # Configure Gemini API Key (using secret)
 # It's better to configure once if the key doesn't change per request often
@@ -67,154 +76,403 @@ class StudyMaterialResponse(BaseModel):
     flashcards: List[FlashcardModel]
     quiz: List[QuizQuestionModel]
 
+# Partial bundle used by the streaming endpoint, where the summary arrives
+# separately as it is generated
+class FlashcardsAndQuizModel(BaseModel):
+    flashcards: List[FlashcardModel]
+    quiz: List[QuizQuestionModel]
+
+# ---- API key pool ----
+# Several keys can be configured via the GEMINI_API_KEYS secret
+# (comma-separated), falling back to the single GEMINI_API_KEY. Keys are
+# handed out round-robin, and a key that hits a rate limit is benched for a
+# cooldown, so the pool's effective QPS is the sum of its healthy keys and a
+# single throttled key no longer forces the mock-data fallback.
+_KEY_COOLDOWN_SECONDS = 60
+
+class _ApiKeyPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []
+        self._next_index = 0
+        self._benched_until = {}  # key -> monotonic time the cooldown ends
+
+    def _load_keys(self):
+        keys_csv = db.secrets.get("GEMINI_API_KEYS") or db.secrets.get("GEMINI_API_KEY") or ""
+        return [key.strip() for key in keys_csv.split(",") if key.strip()]
+
+    def acquire(self):
+        """Return the next healthy key, or None if no keys are configured."""
+        with self._lock:
+            if not self._keys:
+                self._keys = self._load_keys()
+            if not self._keys:
+                return None
+            now = time.monotonic()
+            for _ in range(len(self._keys)):
+                key = self._keys[self._next_index % len(self._keys)]
+                self._next_index += 1
+                if self._benched_until.get(key, 0) <= now:
+                    return key
+            # Every key is cooling down; the one benched longest ago is the best bet
+            return min(self._keys, key=lambda k: self._benched_until.get(k, 0))
+
+    def report_rate_limited(self, key):
+        """Bench a key that just hit a rate limit so acquire() skips it."""
+        with self._lock:
+            if key in self._keys:
+                self._benched_until[key] = time.monotonic() + _KEY_COOLDOWN_SECONDS
+
+_api_key_pool = _ApiKeyPool()
+
+# ---- Model cache ----
+# GenerativeModel construction is idempotent for a given API key, so reuse
+# instances across requests instead of rebuilding them per call.
+_model_cache: dict = {}  # (api_key, model_name) -> genai.GenerativeModel
+_model_cache_lock = threading.Lock()
+_configured_api_key = None
+
+def get_model(api_key, model_name):
+    """Return a GenerativeModel bound to a client for exactly this key.
+
+    genai.configure only swaps global SDK state, and GenerativeModel binds
+    its client lazily on first use - with pooled or user-supplied keys in
+    flight concurrently, a model could end up permanently bound to whichever
+    key configured last. Each cached model is therefore pinned to its own
+    service client up front, so generation always runs (and is billed)
+    against the key it was requested for.
+    """
+    global _configured_api_key
+    with _model_cache_lock:
+        if api_key != _configured_api_key:
+            # Still needed for SDK paths without per-client support
+            # (embeddings, context caching)
+            genai.configure(api_key=api_key)
+            _configured_api_key = api_key
+        model = _model_cache.get((api_key, model_name))
+        if model is None:
+            model = genai.GenerativeModel(model_name)
+            model._client = glm.GenerativeServiceClient(
+                client_options={"api_key": api_key}
+            )
+            _model_cache[(api_key, model_name)] = model
+        return model
+
+# Default model tier. Flash is markedly cheaper and faster than pro, and
+# summaries/flashcards/quizzes don't need pro-level reasoning. Override via
+# the GEMINI_MODEL secret to pin a different tier.
+_DEFAULT_MODEL_NAME = "gemini-1.5-flash"
+
+def get_default_model_name():
+    return db.secrets.get("GEMINI_MODEL") or _DEFAULT_MODEL_NAME
+
+# ---- Gemini context caching ----
+# For very large content, the shared document can be pinned server-side with
+# CachedContent so each call sends only its short instruction instead of
+# re-uploading (and re-billing) the whole document. Only worth it where more
+# than one call runs over the same content, i.e. the streaming endpoint.
+_CONTEXT_CACHE_MIN_CHARS = 150_000  # Gemini refuses to cache below ~32k tokens
+_CONTEXT_CACHE_TTL_MINUTES = 10
+# content hash -> (CachedContent or None, monotonic expiry); None records a
+# failed create so the same content doesn't retry a doomed round trip
+_context_cache = {}
+_context_cache_lock = threading.Lock()
+
+def _versioned_model_name(model_name):
+    """Qualify a model alias for CachedContent, which only accepts
+    explicitly versioned stable models (e.g. models/gemini-1.5-flash-001)."""
+    name = model_name.removeprefix("models/")
+    if not name.rsplit("-", 1)[-1].isdigit():
+        name += "-001"
+    return f"models/{name}"
+
+def get_context_cached_model(model_name, content):
+    """Return a GenerativeModel pinned to server-side cached content, or None.
+
+    Blocking network work on a miss; callers should run it via asyncio.to_thread.
+    Returns None for content below the caching minimum or if caching fails,
+    in which case the caller keeps the plain model and inline content.
+    """
+    if len(content) < _CONTEXT_CACHE_MIN_CHARS:
+        return None
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    now = time.monotonic()
+    with _context_cache_lock:
+        entry = _context_cache.get(content_hash)
+    if entry is not None and entry[1] > now:
+        cached_content = entry[0]
+        if cached_content is None:
+            # A recent create for this content failed; don't retry yet
+            return None
+    else:
+        try:
+            cached_content = genai.caching.CachedContent.create(
+                model=_versioned_model_name(model_name),
+                contents=[content],
+                ttl=datetime.timedelta(minutes=_CONTEXT_CACHE_TTL_MINUTES),
+            )
+        except Exception as e:
+            print(f"Context caching unavailable for this content: {e}")
+            with _context_cache_lock:
+                _context_cache[content_hash] = (None, now + _CONTEXT_CACHE_TTL_MINUTES * 60)
+            return None
+        with _context_cache_lock:
+            # Expire our handle slightly before the server does
+            _context_cache[content_hash] = (cached_content, now + _CONTEXT_CACHE_TTL_MINUTES * 60 - 30)
+    try:
+        return genai.GenerativeModel.from_cached_content(cached_content)
+    except Exception as e:
+        print(f"Could not build model from cached content: {e}")
+        return None
+
+# ---- Response cache ----
+# Two-tier in-process cache so repeated requests skip the Gemini round trip
+# entirely (sub-100ms on a hit vs several seconds on a miss).
+# Tier 1: exact SHA-256 of (input, purpose, difficulty).
+# Tier 2: Gemini embedding of the content with cosine-similarity lookup, so a
+# near-identical request (e.g. the same text re-pasted with minor edits) still hits.
+_RESPONSE_CACHE_MAX_ENTRIES = 256
+_SEMANTIC_SIMILARITY_THRESHOLD = 0.92
+_SEMANTIC_MIN_CONTENT_CHARS = 200  # short inputs only benefit from the exact tier
+_EMBEDDING_MODEL = "models/text-embedding-004"
+_EMBEDDING_MAX_CHARS = 8000  # embedding models have small input limits
+
+_response_cache: dict = {}  # cache_key -> StudyMaterialResponse
+_response_cache_embeddings: list = []  # (embedding, cache_key, purpose, difficulty) tuples
+_response_cache_lock = threading.Lock()
+
+def make_cache_key(content, purpose, difficulty_level):
+    fingerprint = f"{purpose}\x1f{difficulty_level}\x1f{content}"
+    return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+def _embed_for_cache(content):
+    """Embed content for the semantic tier. Returns None if embedding fails."""
+    try:
+        result = genai.embed_content(
+            model=_EMBEDDING_MODEL,
+            content=content[:_EMBEDDING_MAX_CHARS],
+        )
+        return result["embedding"]
+    except Exception as e:
+        print(f"Embedding for semantic cache failed (skipping tier): {e}")
+        return None
+
+def _cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm_a = math.sqrt(sum(x * x for x in a))
+    norm_b = math.sqrt(sum(x * x for x in b))
+    if norm_a == 0 or norm_b == 0:
+        return 0.0
+    return dot / (norm_a * norm_b)
+
+async def lookup_cached_response(cache_key, content, purpose, difficulty_level):
+    """Return (cached StudyMaterialResponse or None, content embedding or None).
+
+    Checks the exact tier first; for long content falls back to the semantic
+    tier. Purpose/difficulty are part of every key, so a semantic hit never
+    crosses preference boundaries. The embedding computed for the lookup is
+    returned so a subsequent store_cached_response can reuse it instead of
+    paying a second embedding round trip.
+    """
+    with _response_cache_lock:
+        cached = _response_cache.get(cache_key)
+    if cached is not None:
+        print("Response cache hit (exact)")
+        return cached, None
+
+    if len(content) < _SEMANTIC_MIN_CONTENT_CHARS:
+        return None, None
+
+    embedding = await asyncio.to_thread(_embed_for_cache, content)
+    if embedding is None:
+        return None, None
+
+    with _response_cache_lock:
+        candidates = list(_response_cache_embeddings)
+    best_key = None
+    best_similarity = 0.0
+    for candidate_embedding, candidate_key, candidate_purpose, candidate_difficulty in candidates:
+        if candidate_purpose != purpose or candidate_difficulty != difficulty_level:
+            continue
+        similarity = _cosine_similarity(embedding, candidate_embedding)
+        if similarity > best_similarity:
+            best_similarity = similarity
+            best_key = candidate_key
+    if best_key is not None and best_similarity >= _SEMANTIC_SIMILARITY_THRESHOLD:
+        with _response_cache_lock:
+            cached = _response_cache.get(best_key)
+        if cached is not None:
+            print(f"Response cache hit (semantic, similarity={best_similarity:.3f})")
+            return cached, embedding
+    return None, embedding
+
+async def store_cached_response(cache_key, content, purpose, difficulty_level, response, embedding=None):
+    """Store a generated response in both cache tiers.
+
+    Pass the embedding returned by lookup_cached_response when available;
+    it is only recomputed here if the lookup didn't produce one.
+    """
+    if embedding is None and len(content) >= _SEMANTIC_MIN_CONTENT_CHARS:
+        embedding = await asyncio.to_thread(_embed_for_cache, content)
+
+    with _response_cache_lock:
+        if len(_response_cache) >= _RESPONSE_CACHE_MAX_ENTRIES:
+            # Evict the oldest entry (dicts preserve insertion order)
+            oldest_key = next(iter(_response_cache))
+            _response_cache.pop(oldest_key, None)
+            _response_cache_embeddings[:] = [
+                entry for entry in _response_cache_embeddings
+                if entry[1] != oldest_key
+            ]
+        _response_cache[cache_key] = response
+        if embedding is not None:
+            _response_cache_embeddings.append(
+                (embedding, cache_key, purpose, difficulty_level)
+            )
+
+# Longest we'll ever wait between retry attempts
+_RETRY_MAX_DELAY = 30  # seconds
+
+def _retry_delay_hint(error):
+    """Pull a server-suggested wait (seconds) out of a Gemini error, if any.
+
+    google.api_core rate-limit errors (429 ResourceExhausted) carry a
+    retry_delay detail; some transports expose a retry_after instead.
+    """
+    retry_delay = getattr(error, "retry_delay", None)
+    if retry_delay is not None:
+        seconds = getattr(retry_delay, "seconds", None)
+        if seconds:
+            return min(float(seconds), _RETRY_MAX_DELAY)
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), _RETRY_MAX_DELAY)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def _is_non_retryable(error):
+    """Auth and malformed-request failures won't succeed on a retry."""
+    message = str(error).lower()
+    return any(marker in message for marker in (
+        "api key", "invalid argument", "permission", "unauthenticated", "credentials"
+    ))
+
 # Helper function to retry API calls with exponential backoff
+# Async-aware so retries don't block the event loop while waiting
 def with_retry(func, max_attempts=5, initial_delay=2):
-    def wrapper(*args, **kwargs):
+    async def wrapper(*args, **kwargs):
         attempts = 0
         delay = initial_delay
-        
+
         while attempts < max_attempts:
             try:
-                return func(*args, **kwargs)
+                return await func(*args, **kwargs)
             except Exception as e:
                 attempts += 1
-                if attempts >= max_attempts:
+                # A bad key or malformed request fails identically every
+                # time - surface it immediately instead of burning retries
+                if attempts >= max_attempts or _is_non_retryable(e):
                     raise e
-                print(f"Attempt {attempts} failed with error: {e}. Retrying in {delay} seconds...")
-                sleep(delay)
-                delay *= 2
-    
-    return wrapper
-
-# Helper function to parse flashcards from Gemini response
-def parse_flashcards(text):
-    flashcards = []
-    
-    # Try to find flashcards in markdown format or other structured formats
-    flashcard_pattern = re.compile(r'\*\*Q:\s*(.+?)\*\*\s*\*\*A:\s*(.+?)\*\*', re.DOTALL)
-    matches = flashcard_pattern.findall(text)
-    
-    if matches:
-        for question, answer in matches:
-            flashcards.append(FlashcardModel(
-                question=question.strip(),
-                answer=answer.strip()
-            ))
-    else:
-        # Alternative format
-        flashcard_pattern = re.compile(r'\d+\.\s*Q:\s*(.+?)\s*A:\s*(.+?)(?=\d+\.\s*Q:|$)', re.DOTALL)
-        matches = flashcard_pattern.findall(text)
-        
-        if matches:
-            for question, answer in matches:
-                flashcards.append(FlashcardModel(
-                    question=question.strip(),
-                    answer=answer.strip()
-                ))
-    
-    return flashcards
+                # Honour the server's suggested wait when rate limited,
+                # otherwise back off exponentially with jitter so concurrent
+                # retries don't hit the API again in lockstep
+                wait = _retry_delay_hint(e)
+                if wait is None:
+                    wait = delay / 2 + random.uniform(0, delay / 2)
+                print(f"Attempt {attempts} failed with error: {e}. Retrying in {wait:.1f} seconds...")
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, _RETRY_MAX_DELAY)
 
-# Helper function to parse quiz questions from Gemini response
-def parse_quiz(text):
-    quiz_questions = []
-    
-    # Regex pattern to find quiz questions with options and correct answers
-    quiz_pattern = re.compile(r'\d+\.\s*(.+?)\s*(?:Options:|A\.)(.*?)(?:Correct answer|correct option|correct choice):?\s*([A-D])', re.DOTALL)
-    matches = quiz_pattern.findall(text)
-    
-    if matches:
-        for question, options_text, correct_answer in matches:
-            # Parse options
-            option_pattern = re.compile(r'([A-D])\.\s*(.+?)(?=[A-D]\.|$)', re.DOTALL)
-            option_matches = option_pattern.findall(options_text)
-            
-            if option_matches:
-                options = []
-                for option_letter, option_text in option_matches:
-                    options.append(QuizQuestionOption(
-                        option=option_text.strip(),
-                        is_correct=(option_letter == correct_answer)
-                    ))
-                
-                quiz_questions.append(QuizQuestionModel(
-                    question=question.strip(),
-                    options=options
-                ))
-    
-    return quiz_questions
+    return wrapper
 
 # Helper function to generate content with prompt engineering
+# The blocking SDK call runs in a worker thread so it doesn't stall the event loop
 @with_retry
-def generate_content(model, prompt):
-    response = model.generate_content(prompt)
+async def generate_content(model, prompt, generation_config=None):
+    response = await asyncio.to_thread(
+        model.generate_content, prompt, generation_config=generation_config
+    )
     return response.text
 
-# Generate summary based on content and preferences
-def generate_summary(model, content, purpose, difficulty_level):
+# Generate summary, flashcards, and quiz in a single Gemini call.
+# One prompt means the (possibly very large) content is sent and billed once
+# instead of three times, and there is a single round trip instead of three.
+async def generate_study_material_bundle(model, content, purpose, difficulty_level):
     prompt = f"""
-    Generate a comprehensive summary of the following content. 
+    Based on the following content, generate study materials for {purpose} purposes at a {difficulty_level} level.
+
+    Content: {content}
+
+    Respond with a single JSON object with exactly these fields:
+    - "summary": a clear, well-structured summary that captures the key concepts and main ideas
+    - "flashcards": a list of 5-10 objects, each with "question" and "answer" strings
+    - "quiz": a list of 5 multiple-choice objects, each with "question" (string), "options" (a list of 4 objects with "option" string and "is_correct" boolean, exactly one true), and "explanation" (string)
+
+    Use appropriate language complexity for a {difficulty_level} level student.
+    For revision purposes, focus on key points, key facts, and memory aids.
+    For deep learning, include more detailed explanations and connections between concepts.
+    For exam preparation, emphasize key definitions, formulas, and likely exam questions.
+    """
+
+    bundle_text = await generate_content(
+        model,
+        prompt,
+        generation_config={
+            "response_mime_type": "application/json",
+            # Gemini enforces the structure, so parsing is a plain JSON load
+            # instead of brittle regex scraping of free text
+            "response_schema": StudyMaterialResponse,
+        },
+    )
+    return StudyMaterialResponse.model_validate_json(bundle_text)
+
+# Build the summary prompt used by the streaming endpoint
+def build_summary_prompt(content, purpose, difficulty_level):
+    return f"""
+    Generate a comprehensive summary of the following content.
     Keep in mind this is for {purpose} purposes at a {difficulty_level} level.
-    
+
     Content: {content}
-    
+
     Please provide a clear, well-structured summary that captures the key concepts and main ideas.
     Use appropriate language complexity for a {difficulty_level} level student.
     For revision purposes, focus on key points and memory aids.
     For deep learning, include more detailed explanations and connections between concepts.
     For exam preparation, emphasize key definitions, formulas, and potential test points.
     """
-    
-    return generate_content(model, prompt)
 
-# Generate flashcards based on content and preferences
-def generate_flashcards(model, content, purpose, difficulty_level):
+# Generate just flashcards and quiz - the streaming endpoint runs this
+# concurrently while the summary streams back to the client
+async def generate_flashcards_and_quiz(model, content, purpose, difficulty_level):
     prompt = f"""
-    Create 5-10 flashcards based on the following content.
-    Keep in mind this is for {purpose} purposes at a {difficulty_level} level.
-    
+    Based on the following content, generate study materials for {purpose} purposes at a {difficulty_level} level.
+
     Content: {content}
-    
-    Format each flashcard as follows:
-    **Q: [Question]**
-    **A: [Answer]**
-    
-    Make sure the questions test understanding at a {difficulty_level} level.
+
+    Respond with a single JSON object with exactly these fields:
+    - "flashcards": a list of 5-10 objects, each with "question" and "answer" strings
+    - "quiz": a list of 5 multiple-choice objects, each with "question" (string), "options" (a list of 4 objects with "option" string and "is_correct" boolean, exactly one true), and "explanation" (string)
+
+    Make sure the questions are at an appropriate {difficulty_level} level.
     For revision purposes, focus on key facts and important recall information.
     For deep learning, focus on conceptual understanding and applications.
     For exam preparation, focus on likely exam questions and key test points.
     """
-    
-    flashcards_text = generate_content(model, prompt)
-    return parse_flashcards(flashcards_text)
 
-# Generate quiz questions based on content and preferences
-def generate_quiz(model, content, purpose, difficulty_level):
-    prompt = f"""
-    Create 5 multiple-choice quiz questions based on the following content.
-    Keep in mind this is for {purpose} purposes at a {difficulty_level} level.
-    
-    Content: {content}
-    
-    Format each question as follows:
-    1. [Question]
-    Options:
-    A. [Option 1]
-    B. [Option 2]
-    C. [Option 3]
-    D. [Option 4]
-    Correct answer: [A/B/C/D]
-    
-    Make sure the questions are at an appropriate {difficulty_level} level.
-    For revision purposes, focus on testing recall of key facts.
-    For deep learning, focus on testing deeper understanding and application.
-    For exam preparation, mimic the style of exam questions for this subject.
-    """
-    
-    quiz_text = generate_content(model, prompt)
-    return parse_quiz(quiz_text)
+    bundle_text = await generate_content(
+        model,
+        prompt,
+        generation_config={
+            "response_mime_type": "application/json",
+            "response_schema": FlashcardsAndQuizModel,
+        },
+    )
+    return FlashcardsAndQuizModel.model_validate_json(bundle_text)
 
 # Helper function to generate content for a given topic
-def generate_topic_content(model, topic, purpose, difficulty_level):
+async def generate_topic_content(model, topic, purpose, difficulty_level):
     prompt = f"""
     Generate comprehensive study material on the topic: {topic}.
     This should be suitable for {purpose} purposes at a {difficulty_level} level.
@@ -227,14 +485,15 @@ def generate_topic_content(model, topic, purpose, difficulty_level):
     - Intermediate: Include more detailed concepts and some specialized terminology
     - Advanced: Cover complex aspects, detailed analysis, and specialized knowledge
     """
-    
-    return generate_content(model, prompt)
+
+    return await generate_content(model, prompt)
 
 @router.post("/generate", response_model=StudyMaterialResponse)
 async def generate_study_materials(request: StudyMaterialRequest):
-    # Determine the API key to use
-    api_key_to_use = request.gemini_api_key if request.gemini_api_key else db.secrets.get("GEMINI_API_KEY")
-    
+    # Determine the API key to use - user-provided key wins, otherwise take
+    # the next healthy key from the pool
+    api_key_to_use = request.gemini_api_key if request.gemini_api_key else _api_key_pool.acquire()
+
     if not api_key_to_use:
         raise HTTPException(
             status_code=400,
@@ -242,11 +501,22 @@ async def generate_study_materials(request: StudyMaterialRequest):
         )
         
     try:
-        # Configure genai with the determined key for this request
-        genai.configure(api_key=api_key_to_use)
-        # Instantiate the model for this specific request
-        model = genai.GenerativeModel('gemini-1.5-pro')
-        
+        # Reuse the configured model instance for this key
+        model = get_model(api_key_to_use, get_default_model_name())
+
+        # Check the response cache keyed on the raw input - a hit skips
+        # every Gemini call (including topic content generation)
+        raw_input = request.content if request.input_method == InputMethod.TEXT else request.topic
+        cache_key = None
+        raw_input_embedding = None
+        if raw_input:
+            cache_key = make_cache_key(raw_input, request.purpose.value, request.difficulty_level.value)
+            cached, raw_input_embedding = await lookup_cached_response(
+                cache_key, raw_input, request.purpose.value, request.difficulty_level.value
+            )
+            if cached is not None:
+                return cached
+
         # Get content based on input method
         if request.input_method == InputMethod.TEXT:
             if not request.content:
@@ -255,43 +525,32 @@ async def generate_study_materials(request: StudyMaterialRequest):
         elif request.input_method == InputMethod.TOPIC:
             if not request.topic:
                 raise HTTPException(status_code=400, detail="Topic is required for topic input method")
-            content = generate_topic_content(
+            content = await generate_topic_content(
                 model, # Pass the model instance
-                request.topic, 
-                request.purpose.value, 
+                request.topic,
+                request.purpose.value,
                 request.difficulty_level.value
             )
         else:  # FILE input method would be handled differently
             raise HTTPException(status_code=400, detail="File upload not supported in this endpoint")
-        
-        # Generate study materials using the request-specific model
-        summary = generate_summary(
-            model, # Pass the model instance
-            content, 
-            request.purpose.value, 
-            request.difficulty_level.value
-        )
-        
-        flashcards = generate_flashcards(
-            model, # Pass the model instance
-            content, 
-            request.purpose.value, 
-            request.difficulty_level.value
-        )
-        
-        quiz = generate_quiz(
+
+        # Generate summary, flashcards, and quiz in one batched call so the
+        # content is only sent (and billed) once
+        response = await generate_study_material_bundle(
             model, # Pass the model instance
-            content, 
-            request.purpose.value, 
+            content,
+            request.purpose.value,
             request.difficulty_level.value
         )
-        
-        return StudyMaterialResponse(
-            summary=summary,
-            flashcards=flashcards,
-            quiz=quiz
-        )
-    
+
+        if cache_key is not None:
+            await store_cached_response(
+                cache_key, raw_input, request.purpose.value, request.difficulty_level.value, response,
+                embedding=raw_input_embedding
+            )
+
+        return response
+
     except Exception as e:
         # Log the error for debugging
         error_message = str(e)
@@ -299,6 +558,9 @@ async def generate_study_materials(request: StudyMaterialRequest):
         
         # Return appropriate error message based on error type
         if "rate limit" in error_message.lower() or "quota" in error_message.lower():
+            # Bench the pooled key so the next request rotates to a healthy one
+            if not request.gemini_api_key:
+                _api_key_pool.report_rate_limited(api_key_to_use)
             # For demo purposes - generate mock data instead when rate limited
             print("Using mock data due to rate limits...")
             return generate_mock_study_materials(request)
@@ -307,6 +569,47 @@ async def generate_study_materials(request: StudyMaterialRequest):
         else:
             raise HTTPException(status_code=500, detail=f"Error generating study materials: {error_message}")
 
+# Topic-independent parts of the mock fixture, built once at import time so
+# the rate-limit fall-through doesn't re-allocate them on every request.
+# Mock responses are never cached or mutated, so sharing instances is safe.
+_MOCK_CONSTANT_FLASHCARDS = [
+    FlashcardModel(question="What are the main components to consider?", answer="The main components include theoretical frameworks, practical applications, and analytical methods."),
+    FlashcardModel(question="How can you apply this knowledge?", answer="This knowledge can be applied through case studies, problem-solving exercises, and real-world projects.")
+]
+
+_MOCK_CONSTANT_QUIZ = [
+    QuizQuestionModel(
+        question="What approach is most effective when studying this subject?",
+        options=[
+            QuizQuestionOption(option="Memorization only", is_correct=False),
+            QuizQuestionOption(option="Practical application combined with theoretical understanding", is_correct=True),
+            QuizQuestionOption(option="Ignoring the fundamentals", is_correct=False),
+            QuizQuestionOption(option="Studying unrelated materials", is_correct=False)
+        ],
+        explanation="A balanced approach that combines theory with practice leads to better comprehension and retention."
+    ),
+    QuizQuestionModel(
+        question="Which statement is true about this topic?",
+        options=[
+            QuizQuestionOption(option="It has no real-world applications", is_correct=False),
+            QuizQuestionOption(option="It's only relevant in academic settings", is_correct=False),
+            QuizQuestionOption(option="It's an interdisciplinary field with broad applications", is_correct=True),
+            QuizQuestionOption(option="It's too complex for practical use", is_correct=False)
+        ],
+        explanation="The interdisciplinary nature of the topic makes it applicable across various fields and settings."
+    ),
+    QuizQuestionModel(
+        question="What is a common misconception about this subject?",
+        options=[
+            QuizQuestionOption(option="It's only theoretical with no practical value", is_correct=True),
+            QuizQuestionOption(option="It requires extensive study to understand basics", is_correct=False),
+            QuizQuestionOption(option="It's a fundamental concept in education", is_correct=False),
+            QuizQuestionOption(option="It's constantly evolving with new research", is_correct=False)
+        ],
+        explanation="The most common misconception is that theoretical knowledge doesn't translate to practical skills, which is false."
+    )
+]
+
 # Generate mock study materials for demo purposes when API rate limits are hit
 def generate_mock_study_materials(request: StudyMaterialRequest) -> StudyMaterialResponse:
     # Determine what content we're dealing with
@@ -326,15 +629,14 @@ def generate_mock_study_materials(request: StudyMaterialRequest) -> StudyMateria
     summary += "It includes definitions, examples, and applications that are relevant to the subject matter. "
     summary += "The content is organized in a logical sequence, starting with fundamental concepts and building towards more complex ideas."
     
-    # Generate mock flashcards
+    # Generate mock flashcards - only the topic-specific ones per request,
+    # the rest come from the precomputed constants
     flashcards = [
         FlashcardModel(question=f"What is {content_topic}?", answer=f"{content_topic.capitalize()} is a subject that covers important concepts in this field."),
         FlashcardModel(question=f"Why is {content_topic} important?", answer=f"It's important because it forms the foundation of understanding in this area of study."),
         FlashcardModel(question=f"Name a key concept in {content_topic}.", answer="One key concept is the relationship between theory and application in real-world scenarios."),
-        FlashcardModel(question="What are the main components to consider?", answer="The main components include theoretical frameworks, practical applications, and analytical methods."),
-        FlashcardModel(question="How can you apply this knowledge?", answer="This knowledge can be applied through case studies, problem-solving exercises, and real-world projects.")
-    ]
-    
+    ] + _MOCK_CONSTANT_FLASHCARDS
+
     # Generate mock quiz questions
     quiz = [
         QuizQuestionModel(
@@ -357,37 +659,7 @@ def generate_mock_study_materials(request: StudyMaterialRequest) -> StudyMateria
             ],
             explanation="While the subject integrates knowledge from various fields, unrelated concepts are not considered key aspects."
         ),
-        QuizQuestionModel(
-            question="What approach is most effective when studying this subject?",
-            options=[
-                QuizQuestionOption(option="Memorization only", is_correct=False),
-                QuizQuestionOption(option="Practical application combined with theoretical understanding", is_correct=True),
-                QuizQuestionOption(option="Ignoring the fundamentals", is_correct=False),
-                QuizQuestionOption(option="Studying unrelated materials", is_correct=False)
-            ],
-            explanation="A balanced approach that combines theory with practice leads to better comprehension and retention."
-        ),
-        QuizQuestionModel(
-            question="Which statement is true about this topic?",
-            options=[
-                QuizQuestionOption(option="It has no real-world applications", is_correct=False),
-                QuizQuestionOption(option="It's only relevant in academic settings", is_correct=False),
-                QuizQuestionOption(option="It's an interdisciplinary field with broad applications", is_correct=True),
-                QuizQuestionOption(option="It's too complex for practical use", is_correct=False)
-            ],
-            explanation="The interdisciplinary nature of the topic makes it applicable across various fields and settings."
-        ),
-        QuizQuestionModel(
-            question="What is a common misconception about this subject?",
-            options=[
-                QuizQuestionOption(option="It's only theoretical with no practical value", is_correct=True),
-                QuizQuestionOption(option="It requires extensive study to understand basics", is_correct=False),
-                QuizQuestionOption(option="It's a fundamental concept in education", is_correct=False),
-                QuizQuestionOption(option="It's constantly evolving with new research", is_correct=False)
-            ],
-            explanation="The most common misconception is that theoretical knowledge doesn't translate to practical skills, which is false."
-        )
-    ]
+    ] + _MOCK_CONSTANT_QUIZ
     
     return StudyMaterialResponse(
         summary=summary,
@@ -395,6 +667,156 @@ def generate_mock_study_materials(request: StudyMaterialRequest) -> StudyMateria
         quiz=quiz
     )
 
+# Streaming variant of /generate. Summary text is forwarded to the client as
+# Gemini produces it while flashcards and quiz generate concurrently, so the
+# user starts reading the summary seconds before the full bundle is ready.
+# Emits newline-delimited JSON events:
+#   {"type": "summary_chunk", "text": ...}   (repeated)
+#   {"type": "materials", "flashcards": [...], "quiz": [...]}
+#   {"type": "error", "detail": ...}         (on failure mid-stream)
+@router.post("/generate-stream")
+async def generate_study_materials_stream(request: StudyMaterialRequest):
+    api_key_to_use = request.gemini_api_key if request.gemini_api_key else _api_key_pool.acquire()
+
+    if not api_key_to_use:
+        raise HTTPException(
+            status_code=400,
+            detail="Gemini API key not found. Please provide one or configure it in secrets."
+        )
+
+    if request.input_method == InputMethod.TEXT:
+        if not request.content:
+            raise HTTPException(status_code=400, detail="Content is required for text input method")
+    elif request.input_method == InputMethod.TOPIC:
+        if not request.topic:
+            raise HTTPException(status_code=400, detail="Topic is required for topic input method")
+    else:
+        raise HTTPException(status_code=400, detail="File upload not supported in this endpoint")
+
+    model_name = get_default_model_name()
+    model = get_model(api_key_to_use, model_name)
+
+    async def event_stream():
+        materials_task = None
+        try:
+            raw_input = request.content if request.input_method == InputMethod.TEXT else request.topic
+            cache_key = make_cache_key(raw_input, request.purpose.value, request.difficulty_level.value)
+            cached, raw_input_embedding = await lookup_cached_response(
+                cache_key, raw_input, request.purpose.value, request.difficulty_level.value
+            )
+            if cached is not None:
+                yield json.dumps({"type": "summary_chunk", "text": cached.summary}) + "\n"
+                yield json.dumps({"type": "materials", **cached.model_dump(exclude={"summary"})}) + "\n"
+                return
+
+            if request.input_method == InputMethod.TOPIC:
+                content = await generate_topic_content(
+                    model, request.topic, request.purpose.value, request.difficulty_level.value
+                )
+            else:
+                content = request.content
+
+            # For very large content, pin the document server-side so the two
+            # calls below each send only their short instruction
+            prompt_model = model
+            content_for_prompt = content
+            context_model = await asyncio.to_thread(
+                get_context_cached_model, model_name, content
+            )
+            if context_model is not None:
+                prompt_model = context_model
+                content_for_prompt = "the attached document"
+
+            # Kick off flashcards/quiz first so they generate while the
+            # summary streams back
+            materials_task = asyncio.create_task(
+                generate_flashcards_and_quiz(
+                    prompt_model, content_for_prompt, request.purpose.value, request.difficulty_level.value
+                )
+            )
+
+            summary_prompt = build_summary_prompt(content_for_prompt, request.purpose.value, request.difficulty_level.value)
+            summary_stream = await asyncio.to_thread(prompt_model.generate_content, summary_prompt, stream=True)
+            summary_iter = iter(summary_stream)
+            summary_parts = []
+            while True:
+                # The SDK iterator blocks on the network, so advance it in a thread
+                chunk = await asyncio.to_thread(next, summary_iter, None)
+                if chunk is None:
+                    break
+                try:
+                    chunk_text = chunk.text
+                except Exception:
+                    continue  # skip empty/filtered parts
+                if chunk_text:
+                    summary_parts.append(chunk_text)
+                    yield json.dumps({"type": "summary_chunk", "text": chunk_text}) + "\n"
+
+            materials = await materials_task
+            yield json.dumps({"type": "materials", **materials.model_dump()}) + "\n"
+
+            await store_cached_response(
+                cache_key, raw_input, request.purpose.value, request.difficulty_level.value,
+                StudyMaterialResponse(
+                    summary="".join(summary_parts),
+                    flashcards=materials.flashcards,
+                    quiz=materials.quiz,
+                ),
+                embedding=raw_input_embedding,
+            )
+        except Exception as e:
+            # Headers are already sent, so report failures as a stream event
+            print(f"Error generating streamed study materials: {e}")
+            yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+        finally:
+            # If the summary stream failed (or the client disconnected), don't
+            # leave the flashcards/quiz task running unobserved - its eventual
+            # exception would surface as an unretrieved-task warning
+            if materials_task is not None and not materials_task.done():
+                materials_task.cancel()
+                try:
+                    await materials_task
+                except (Exception, asyncio.CancelledError):
+                    pass
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+# Chunk size for streaming uploads to disk
+_UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+
+# Cap on how much extracted text is sent to Gemini. Prompt cost and latency
+# grow linearly with input size while the quality of a 5-question quiz and a
+# handful of flashcards plateaus well before this point.
+_MAX_CONTENT_CHARS = 60_000
+
+def truncate_content(text, max_chars=_MAX_CONTENT_CHARS):
+    """Cap text at max_chars, preferring a paragraph or sentence boundary."""
+    if len(text) <= max_chars:
+        return text
+    truncated = text[:max_chars]
+    boundary = truncated.rfind("\n\n")
+    if boundary < max_chars // 2:
+        boundary = truncated.rfind(". ")
+    if boundary > max_chars // 2:
+        truncated = truncated[:boundary + 1]
+    print(f"Truncated content from {len(text)} to {len(truncated)} characters before sending to Gemini.")
+    return truncated
+
+# Extract all page text from a PDF on disk.
+# This is blocking fitz work; callers should run it via asyncio.to_thread.
+def extract_pdf_text(pdf_path):
+    pdf_document = fitz.open(pdf_path, filetype="pdf")
+    # Collect per-page text and join once - += rebuilds the accumulated
+    # string on every page, which is quadratic over large documents
+    page_texts = []
+    for page_num in range(len(pdf_document)):
+        page = pdf_document.load_page(page_num)
+        # Plain text with explicit flags: keep layout whitespace but skip
+        # image extraction/decoding, which only the prompt would pay for
+        page_texts.append(page.get_text("text", flags=fitz.TEXT_PRESERVE_WHITESPACE))
+    pdf_document.close()
+    return "".join(page_texts)
+
 # Add the new file upload endpoint
 @router.post("/process-file-upload", response_model=StudyMaterialResponse)
 async def process_file_upload(
@@ -405,23 +827,42 @@ async def process_file_upload(
 ):
     """Handles PDF/TXT file upload, extracts text, and generates study materials."""
     extracted_text = ""
+    tmp_path = None
     try:
-        file_content_bytes = await file.read()
+        # Stream the upload to a temp file in chunks so large files never sit
+        # fully in memory alongside their extracted text; hash the bytes on
+        # the way through for dedupe
+        hasher = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
+            tmp_path = tmp_file.name
+            while chunk := await file.read(_UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+                tmp_file.write(chunk)
+        file_digest = hasher.hexdigest()
+
+        # The same bytes with the same preferences produce the same materials,
+        # so a repeat upload skips extraction and generation entirely. The key
+        # is a digest, so only the exact cache tier applies.
+        upload_cache_key = make_cache_key(file_digest, purpose.value, difficulty_level.value)
+        cached, _ = await lookup_cached_response(
+            upload_cache_key, file_digest, purpose.value, difficulty_level.value
+        )
+        if cached is not None:
+            return cached
 
         if file.content_type == "application/pdf":
             try:
-                # Use io.BytesIO to treat the bytes as a file-like object for fitz
-                pdf_document = fitz.open(stream=io.BytesIO(file_content_bytes), filetype="pdf")
-                for page_num in range(len(pdf_document)):
-                    page = pdf_document.load_page(page_num)
-                    extracted_text += page.get_text()
-                pdf_document.close()
+                # Extraction is blocking fitz work, so run it in a worker
+                # thread to keep the event loop free for other requests
+                extracted_text = await asyncio.to_thread(extract_pdf_text, tmp_path)
                 print(f"Extracted {len(extracted_text)} characters from PDF.")
             except Exception as pdf_error:
                 print(f"PDF processing error: {pdf_error}")
                 raise HTTPException(status_code=400, detail=f"Error processing PDF file: {pdf_error}")
 
         elif file.content_type == "text/plain":
+            with open(tmp_path, "rb") as text_file:
+                file_content_bytes = text_file.read()
             try:
                 extracted_text = file_content_bytes.decode("utf-8")
                 print(f"Read {len(extracted_text)} characters from TXT.")
@@ -439,8 +880,12 @@ async def process_file_upload(
         if not extracted_text.strip():
              raise HTTPException(status_code=400, detail="File seems empty or text could not be extracted.")
 
+        # Cap the prompt size - very large documents cost and delay far more
+        # than they improve the generated materials
+        extracted_text = truncate_content(extracted_text)
+
         # ---- Reuse existing Gemini logic ----
-        api_key_to_use = gemini_api_key if gemini_api_key else db.secrets.get("GEMINI_API_KEY")
+        api_key_to_use = gemini_api_key if gemini_api_key else _api_key_pool.acquire()
         if not api_key_to_use:
             raise HTTPException(
                 status_code=400,
@@ -448,43 +893,30 @@ async def process_file_upload(
             )
 
         try:
-            genai.configure(api_key=api_key_to_use)
-            # Select the appropriate model - consider making this configurable or using a specific version
-            model = genai.GenerativeModel('gemini-1.5-flash') # Using flash for potentially faster/cheaper generation
+            model = get_model(api_key_to_use, get_default_model_name())
             print(f"Using model: {model.model_name} for file processing")
 
-            # Generate study materials using the extracted text
-            summary = generate_summary(
-                model,
-                extracted_text,
-                purpose.value,
-                difficulty_level.value
-            )
-
-            flashcards = generate_flashcards(
+            # Generate all study materials in one batched call so the
+            # extracted text is only sent (and billed) once
+            response = await generate_study_material_bundle(
                 model,
                 extracted_text,
                 purpose.value,
                 difficulty_level.value
             )
 
-            quiz = generate_quiz(
-                model,
-                extracted_text,
-                purpose.value,
-                difficulty_level.value
+            await store_cached_response(
+                upload_cache_key, file_digest, purpose.value, difficulty_level.value, response
             )
 
-            return StudyMaterialResponse(
-                summary=summary,
-                flashcards=flashcards,
-                quiz=quiz
-            )
+            return response
         except Exception as gemini_error:
             # Handle specific Gemini errors
             error_message = str(gemini_error)
             print(f"Gemini API error during file processing: {error_message}")
             if "rate limit" in error_message.lower() or "quota" in error_message.lower():
+                 if not gemini_api_key:
+                     _api_key_pool.report_rate_limited(api_key_to_use)
                  raise HTTPException(status_code=429, detail="API rate limit exceeded. Please try again later.")
             elif "invalid" in error_message.lower() or "api key" in error_message.lower() or "credentials" in error_message.lower():
                 raise HTTPException(status_code=401, detail="Invalid API key or authentication error.")
@@ -500,4 +932,10 @@ async def process_file_upload(
         error_message = str(e)
         print(f"Unexpected error processing file upload: {error_message}")
         raise HTTPException(status_code=500, detail=f"Error processing file: {error_message}")
+    finally:
+        if tmp_path is not None:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
 